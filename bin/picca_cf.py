@@ -328,14 +328,19 @@ def main(cmdargs):
     cpu_data = {healpix: [healpix] for healpix in data}
     context = multiprocessing.get_context('fork')
     pool = context.Pool(processes=args.nproc)
-    correlation_function_data = pool.map(corr_func, sorted(cpu_data.values()))
+    # write the results of each healpix directly into a pre-allocated buffer
+    # with shape (num_healpix, 6, num_bins); imap keeps the healpix ordering
+    correlation_function_data = np.empty(
+        (len(cpu_data), 6, cf.num_bins_r_par * cf.num_bins_r_trans))
+    for index, healpix_data in enumerate(
+            pool.imap(corr_func, sorted(cpu_data.values()))):
+        correlation_function_data[index] = healpix_data
     pool.close()
 
     t2 = time.time()
     userprint(f'picca_cf.py - Time computing correlation function: {(t2-t1)/60:.3f} minutes')
 
     # group data from parallelisation
-    correlation_function_data = np.array(correlation_function_data)
     weights_list = correlation_function_data[:, 0, :]
     xi_list = correlation_function_data[:, 1, :]
     r_par_list = correlation_function_data[:, 2, :]
@@ -345,13 +350,14 @@ def main(cmdargs):
     healpix_list = np.array(sorted(list(cpu_data.keys())))
 
     # normalize values
-    w = (weights_list.sum(axis=0) > 0.)
+    weights_sum = weights_list.sum(axis=0)
+    w = (weights_sum > 0.)
     r_par = (r_par_list * weights_list).sum(axis=0)
-    r_par[w] /= weights_list.sum(axis=0)[w]
+    r_par[w] /= weights_sum[w]
     r_trans = (r_trans_list * weights_list).sum(axis=0)
-    r_trans[w] /= weights_list.sum(axis=0)[w]
+    r_trans[w] /= weights_sum[w]
     z = (z_list * weights_list).sum(axis=0)
-    z[w] /= weights_list.sum(axis=0)[w]
+    z[w] /= weights_sum[w]
     num_pairs = num_pairs_list.sum(axis=0)
 
     # save data
@@ -3,7 +3,6 @@
 It includes the class Cosmo, used to store the fiducial cosmology
 """
 import fitsio
-import scipy as sp
 import numpy as np
 from scipy import interpolate
 from scipy.constants import speed_of_light as speed_light
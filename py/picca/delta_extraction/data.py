@@ -3,6 +3,8 @@ classes loading data must inherit
 """
 import logging
 import multiprocessing
+import os
+import shutil
 
 import numpy as np
 import fitsio
@@ -13,7 +15,13 @@ from picca.delta_extraction.astronomical_objects.pk1d_forest import Pk1dForest
 from picca.delta_extraction.errors import DataError
 from picca.delta_extraction.rejection_logs.rejection_log_from_image import RejectionLogFromImage
 from picca.delta_extraction.rejection_logs.rejection_log_from_table import RejectionLogFromTable
-from picca.delta_extraction.utils import ABSORBER_IGM
+from picca.delta_extraction.utils import ABSORBER_IGM, PROGRESS_LEVEL_NUM
+
+# use the faster ISA-L implementation of gzip if it is available
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
 
 accepted_options = [
     "analysis type",
@@ -57,6 +65,36 @@ accepted_analysis_type = ["BAO 3D", "PK 1D"]
 accepted_save_format = ["BinTableHDU", "ImageHDU"]
 
 
+def _compress_file(filename_tmp, filename):
+    """Compress a file with gzip and remove the uncompressed file.
+
+    Writing an uncompressed FITS file and compressing it afterwards is
+    faster than letting fitsio compress the file on the fly. The
+    uncompressed file should be named so that it is not picked up by the
+    readers (e.g. with a ".tmp" extension). It is only removed once the
+    compression succeeded. If the compression fails, the partial
+    compressed file is removed instead. Both files exist during the
+    compression, so it needs some extra disk space.
+
+    Arguments
+    ---------
+    filename_tmp: str
+    Name of the uncompressed file
+
+    filename: str
+    Name of the compressed file
+    """
+    try:
+        with open(filename_tmp, "rb") as file_in:
+            with gzip.open(filename, "wb") as file_out:
+                shutil.copyfileobj(file_in, file_out)
+    except BaseException:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    os.remove(filename_tmp)
+
+
 def _save_deltas_one_healpix_image(out_dir, healpix, forests):
     """Saves the deltas that belong to one healpix in ImageHDU format.
 
@@ -75,9 +113,10 @@ def _save_deltas_one_healpix_image(out_dir, healpix, forests):
     forests: List of forests
     List of forests to later add to rejection log as accepted.
     """
-    results = fitsio.FITS(f"{out_dir}/Delta/delta-{healpix}.fits.gz",
-                          'rw',
-                          clobber=True)
+    filename = f"{out_dir}/Delta/delta-{healpix}.fits.gz"
+    # the readers ignore the ".tmp" files, e.g. if the compression fails
+    filename_tmp = f"{out_dir}/Delta/delta-{healpix}.fits.tmp"
+    results = fitsio.FITS(filename_tmp, 'rw', clobber=True)
 
     results.write(None) # This works as Primary
 
@@ -192,6 +231,9 @@ def _save_deltas_one_healpix_image(out_dir, healpix, forests):
     results["CONT"].write_comment("Quasar continuum in wavelength bins")
     results["CONT"].write_checksum()
 
+    results.close()
+    _compress_file(filename_tmp, filename)
+
     return forests
 
 
@@ -213,9 +255,10 @@ def _save_deltas_one_healpix_table(out_dir, healpix, forests):
     forests: List of forests
     List of forests to later add to rejection log as accepted.
     """
-    results = fitsio.FITS(f"{out_dir}/Delta/delta-{healpix}.fits.gz",
-                          'rw',
-                          clobber=True)
+    filename = f"{out_dir}/Delta/delta-{healpix}.fits.gz"
+    # the readers ignore the ".tmp" files, e.g. if the compression fails
+    filename_tmp = f"{out_dir}/Delta/delta-{healpix}.fits.tmp"
+    results = fitsio.FITS(filename_tmp, 'rw', clobber=True)
 
     for forest in forests:
         header = forest.get_header()
@@ -228,6 +271,7 @@ def _save_deltas_one_healpix_table(out_dir, healpix, forests):
                       extname=str(forest.los_id))
 
     results.close()
+    _compress_file(filename_tmp, filename)
 
     return forests
 
@@ -380,23 +424,19 @@ class Data:
         if flux_units is None:
             raise DataError("Missing argument 'flux units' required by Data")
 
-        lambda_max = config.getfloat("lambda max")
-        if lambda_max is None:
-            raise DataError("Missing argument 'lambda max' required by Data")
-        lambda_max_rest_frame = config.getfloat("lambda max rest frame")
-        if lambda_max_rest_frame is None:
-            raise DataError(
-                "Missing argument 'lambda max rest frame' required by Data")
-        lambda_min = config.getfloat("lambda min")
-        if lambda_min is None:
-            raise DataError("Missing argument 'lambda min' required by Data")
-        lambda_min_rest_frame = config.getfloat("lambda min rest frame")
-        if lambda_min_rest_frame is None:
-            raise DataError(
-                "Missing argument 'lambda min rest frame' required by Data")
-
-        Forest.set_class_variables(lambda_min, lambda_max,
-                                   lambda_min_rest_frame, lambda_max_rest_frame,
+        lambda_limits = {}
+        for key in [
+                "lambda max", "lambda max rest frame", "lambda min",
+                "lambda min rest frame"
+        ]:
+            lambda_limits[key] = config.getfloat(key)
+            if lambda_limits[key] is None:
+                raise DataError(f"Missing argument '{key}' required by Data")
+
+        Forest.set_class_variables(lambda_limits["lambda min"],
+                                   lambda_limits["lambda max"],
+                                   lambda_limits["lambda min rest frame"],
+                                   lambda_limits["lambda max rest frame"],
                                    pixel_step, pixel_step_rest_frame,
                                    wave_solution, flux_units)
 
@@ -493,22 +533,31 @@ class Data:
 
     def filter_bad_cont_forests(self):
         """Remove forests where continuum could not be computed"""
-        remove_indexs = []
-        for index, forest in enumerate(self.forests):
-            if forest.bad_continuum_reason is not None:
-                # store information for logs
-                self.rejection_log.add_to_rejection_log(
-                    forest, forest.bad_continuum_reason)
-
+        bad_continuum = np.fromiter(
+            (forest.bad_continuum_reason is not None
+             for forest in self.forests),
+            dtype=bool,
+            count=len(self.forests))
+
+        # only format the rejection messages if they are going to be logged
+        log_progress = self.logger.isEnabledFor(PROGRESS_LEVEL_NUM)
+        for index in np.nonzero(bad_continuum)[0]:
+            forest = self.forests[index]
+            # store information for logs
+            self.rejection_log.add_to_rejection_log(
+                forest, forest.bad_continuum_reason)
+
+            if log_progress:
                 self.logger.progress(
                     f"Rejected forest with los_id {forest.los_id} "
                     "due to continuum fitting problems. Reason: "
                     f"{forest.bad_continuum_reason}")
 
-                remove_indexs.append(index)
-
-        for index in sorted(remove_indexs, reverse=True):
-            del self.forests[index]
+        # remove forests
+        self.forests = [
+            forest for forest, bad in zip(self.forests, bad_continuum)
+            if not bad
+        ]
 
         self.logger.progress(f"Accepted sample has {len(self.forests)} forests")
 
@@ -516,33 +565,57 @@ class Data:
         """Remove forests that do not meet quality standards"""
         self.logger.progress(f"Input sample has {len(self.forests)} forests")
 
-        remove_indexs = []
-        for index, forest in enumerate(self.forests):
-            if np.sum(forest.ivar > 0) < self.min_num_pix:
+        # gather the quantities used by the filters in arrays so that the
+        # selection is done with vectorized masks
+        num_forests = len(self.forests)
+        num_pixels = np.fromiter(
+            (np.sum(forest.ivar > 0) for forest in self.forests),
+            dtype=int,
+            count=num_forests)
+        has_nan = np.fromiter(
+            (np.isnan((forest.flux * forest.ivar).sum())
+             for forest in self.forests),
+            dtype=bool,
+            count=num_forests)
+        mean_snr = np.fromiter((forest.mean_snr for forest in self.forests),
+                               dtype=float,
+                               count=num_forests)
+
+        short_forest = num_pixels < self.min_num_pix
+        nan_forest = ~short_forest & has_nan
+        low_snr_forest = ~short_forest & ~has_nan & (mean_snr < self.min_snr)
+        remove = short_forest | nan_forest | low_snr_forest
+
+        # only format the rejection messages if they are going to be logged
+        log_progress = self.logger.isEnabledFor(PROGRESS_LEVEL_NUM)
+        for index in np.nonzero(remove)[0]:
+            forest = self.forests[index]
+            if short_forest[index]:
                 # store information for logs
                 self.rejection_log.add_to_rejection_log(forest, "short_forest")
-                self.logger.progress(
-                    f"Rejected forest with los_id {forest.los_id} "
-                    f"due to forest being too short ({forest.flux.size})")
-            elif np.isnan((forest.flux * forest.ivar).sum()):
+                if log_progress:
+                    self.logger.progress(
+                        f"Rejected forest with los_id {forest.los_id} "
+                        f"due to forest being too short ({forest.flux.size})")
+            elif nan_forest[index]:
                 self.rejection_log.add_to_rejection_log(forest, "nan_forest")
-                self.logger.progress(
-                    f"Rejected forest with los_id {forest.los_id} "
-                    "due to finding nan")
-            elif forest.mean_snr < self.min_snr:
+                if log_progress:
+                    self.logger.progress(
+                        f"Rejected forest with los_id {forest.los_id} "
+                        "due to finding nan")
+            else:
                 self.rejection_log.add_to_rejection_log(
                     forest, f"low SNR ({forest.mean_snr})")
-                self.logger.progress(
-                    f"Rejected forest with los_id {forest.los_id} "
-                    f"due to low SNR ({forest.mean_snr} < {self.min_snr})")
-            else:
-                continue
-
-            remove_indexs.append(index)
+                if log_progress:
+                    self.logger.progress(
+                        f"Rejected forest with los_id {forest.los_id} "
+                        f"due to low SNR ({forest.mean_snr} < {self.min_snr})")
 
         # remove forests
-        for index in sorted(remove_indexs, reverse=True):
-            del self.forests[index]
+        self.forests = [
+            forest for forest, removed in zip(self.forests, remove)
+            if not removed
+        ]
 
         self.logger.progress("Removed forests that are too short")
         self.logger.progress(
@@ -554,31 +627,44 @@ class Data:
         self.logger.progress("determining nside")
         nside = 256
         target_mean_num_obj = 500
-        ra = np.array([forest.ra for forest in self.forests])
-        dec = np.array([forest.dec for forest in self.forests])
-        healpixs = healpy.ang2pix(nside, np.pi / 2 - dec, ra)
-
-        mean_num_obj = len(healpixs) / len(np.unique(healpixs))
+        ra = np.fromiter((forest.ra for forest in self.forests),
+                         dtype=np.float64,
+                         count=len(self.forests))
+        dec = np.fromiter((forest.dec for forest in self.forests),
+                          dtype=np.float64,
+                          count=len(self.forests))
+        # pixels are computed only once using the NESTED scheme; the parent
+        # of a pixel at nside//2 is then obtained by dropping its last two bits
+        healpixs_nest = healpy.ang2pix(nside, np.pi / 2 - dec, ra, nest=True)
+
+        mean_num_obj = len(healpixs_nest) / len(np.unique(healpixs_nest))
         nside_min = 8
         while mean_num_obj < target_mean_num_obj and nside >= nside_min:
             nside //= 2
-            healpixs = healpy.ang2pix(nside, np.pi / 2 - dec, ra)
-            mean_num_obj = len(healpixs) / len(np.unique(healpixs))
+            healpixs_nest >>= 2
+            mean_num_obj = len(healpixs_nest) / len(np.unique(healpixs_nest))
 
         self.logger.progress(f"nside = {nside} -- mean #obj per pixel = "
                              f"{mean_num_obj}")
 
+        # keep the RING scheme for the saved healpix numbers
+        healpixs = healpy.nest2ring(nside, healpixs_nest)
         for forest, healpix in zip(self.forests, healpixs):
             forest.healpix = healpix
 
     def save_deltas(self):
         """Save the deltas."""
         healpixs = np.array([forest.healpix for forest in self.forests])
-        unique_healpixs = np.unique(healpixs)
+
+        # group forests by healpix with a single sort instead of scanning
+        # the full array once per healpix
+        sort_indexs = np.argsort(healpixs, kind="stable")
+        unique_healpixs, start_indexs = np.unique(healpixs[sort_indexs],
+                                                  return_index=True)
+        healpixs_indexs = np.split(sort_indexs, start_indexs[1:])
 
         arguments = []
-        for healpix in unique_healpixs:
-            this_idx = np.nonzero(healpix == healpixs)[0]
+        for healpix, this_idx in zip(unique_healpixs, healpixs_indexs):
             grouped_forests = sorted([self.forests[i] for i in this_idx])
             arguments.append(
                 (self.out_dir, healpix, grouped_forests, self.save_format))
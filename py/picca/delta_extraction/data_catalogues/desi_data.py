@@ -282,7 +282,7 @@ class DesiDataFileHandler():
         spectrographs_data: dict
         The read data
 
-        targetid_spec: int
+        targetid_spec: array of int
         Targetid of the objects to format
 
         reso_from_truth: bool - Default: False
@@ -300,13 +300,19 @@ class DesiDataFileHandler():
         num_data = 0
         forests_by_targetid = {}
 
+        # Map each targetid to the rows of the file where it is found
+        # so that quasars are matched without scanning targetid_spec each time
+        rows_by_targetid = {}
+        for index, targetid in enumerate(targetid_spec.tolist()):
+            rows_by_targetid.setdefault(targetid, []).append(index)
+
         # Loop over quasars in catalogue fragment
         for row in catalogue:
             # Find which row in tile contains this quasar
             # It should be there by construction
             targetid = row["TARGETID"]
-            w_t = np.where(targetid_spec == targetid)[0]
-            if len(w_t) == 0:
+            w_t = rows_by_targetid.get(targetid)
+            if w_t is None:
                 self.logger.warning(
                     f"Error reading {targetid}. Ignoring object")
                 continue
@@ -314,6 +320,7 @@ class DesiDataFileHandler():
                 self.logger.warning(
                     "Warning: more than one spectrum in this file "
                     f"for {targetid}")
+                w_t = np.array(w_t)
             else:
                 w_t = w_t[0]
             # Construct DesiForest instance
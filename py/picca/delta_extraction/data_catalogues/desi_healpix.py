@@ -115,11 +115,16 @@ class DesiHealpix(DesiData):
 
         if self.num_processors > 1:
             context = multiprocessing.get_context('fork')
+            # send the files to the workers in batches to reduce the
+            # inter-process communication overhead
+            chunksize = max(1, len(arguments) // (4 * self.num_processors))
             with context.Pool(processes=self.num_processors) as pool:
                 imap_it = pool.imap(
                     DesiHealpixFileHandler(self.analysis_type,
                                            self.use_non_coadded_spectra,
-                                           self.logger), arguments)
+                                           self.logger),
+                    arguments,
+                    chunksize=chunksize)
                 for forests_by_targetid_aux, _ in imap_it:
                     # Merge each dict to master forests_by_targetid
                     merge_new_forest(forests_by_targetid,
@@ -188,7 +193,18 @@ class DesiHealpixFileHandler(DesiDataFileHandler):
             self.logger.warning(f"Error reading '{filename}'. Ignoring file")
             return {}, 0
         # Read targetid from fibermap to match to catalogue later
-        fibermap = hdul['FIBERMAP'].read()
+        fibermap = hdul['FIBERMAP'].read(columns=["TARGETID"])
+        targetid_spec = fibermap["TARGETID"]
+
+        # Only the rows between the first and the last quasar of the
+        # catalogue are read (fitsio only supports contiguous slices)
+        rows = np.nonzero(np.isin(targetid_spec, catalogue["TARGETID"]))[0]
+        if rows.size > 0:
+            rows_slice = slice(rows[0], rows[-1] + 1)
+        else:
+            rows_slice = slice(0, 0)
+        targetid_spec = targetid_spec[rows_slice]
+
         # First read all wavelength, flux, ivar, mask, and resolution
         # from this file
         spectrographs_data = {}
@@ -215,7 +231,7 @@ class DesiHealpixFileHandler(DesiDataFileHandler):
 
         def _read_resolution(color):
             if f"{color}_RESOLUTION" in hdul:
-                return hdul[f"{color}_RESOLUTION"].read()
+                return hdul[f"{color}_RESOLUTION"][rows_slice, :, :]
             if hdul_truth is not None:
                 return hdul_truth[f"{color}_RESOLUTION"].read()
 
@@ -229,10 +245,14 @@ class DesiHealpixFileHandler(DesiDataFileHandler):
             spec = {}
             try:
                 spec["WAVELENGTH"] = hdul[f"{color}_WAVELENGTH"].read()
-                spec["FLUX"] = hdul[f"{color}_FLUX"].read()
-                spec["IVAR"] = (hdul[f"{color}_IVAR"].read() *
-                                (hdul[f"{color}_MASK"].read() == 0))
-                w = np.isnan(spec["FLUX"]) | np.isnan(spec["IVAR"])
+                spec["FLUX"] = hdul[f"{color}_FLUX"][rows_slice, :]
+                spec["IVAR"] = hdul[f"{color}_IVAR"][rows_slice, :]
+                # mask in place to avoid full-size temporary copies
+                np.multiply(spec["IVAR"],
+                            hdul[f"{color}_MASK"][rows_slice, :] == 0,
+                            out=spec["IVAR"])
+                w = np.isnan(spec["FLUX"])
+                w |= np.isnan(spec["IVAR"])
                 for key in ["FLUX", "IVAR"]:
                     spec[key][w] = 0.
 
@@ -251,7 +271,7 @@ class DesiHealpixFileHandler(DesiDataFileHandler):
         forests_by_targetid, num_data = self.format_data(
             catalogue,
             spectrographs_data,
-            fibermap["TARGETID"],
+            targetid_spec,
             reso_from_truth=reso_from_truth)
 
         return forests_by_targetid, num_data
@@ -4,6 +4,7 @@ import os
 import logging
 import glob
 import multiprocessing
+import re
 
 import fitsio
 import numpy as np
@@ -66,38 +67,54 @@ class DesiTile(DesiData):
                                    f"**/{coadd_name}-*.fits"),
                       recursive=True))
 
+        # group the catalogue by petal/tile/night once so that each file
+        # only receives the quasars that can be found in it
         if "cumulative" in self.input_directory:
-            petal_tile_night = [
-                f"{entry['PETAL_LOC']}-{entry['TILEID']}-thru{entry['LASTNIGHT']}"
-                for entry in self.catalogue
-            ]
+            grouped_catalogue = self.catalogue.group_by(
+                ["PETAL_LOC", "TILEID", "LASTNIGHT"])
+            catalogue_by_petal_tile_night = {
+                f"{group['PETAL_LOC'][0]}-{group['TILEID'][0]}-"
+                f"thru{group['LASTNIGHT'][0]}": group
+                for group in grouped_catalogue.groups
+            }
         else:
-            petal_tile_night = [
-                f"{entry['PETAL_LOC']}-{entry['TILEID']}-{entry['NIGHT']}"
-                for entry in self.catalogue
-            ]
-
-        # this uniqueness check is to ensure each petal/tile/night combination
-        # only appears once in the filelist
-        petal_tile_night_unique = np.unique(petal_tile_night)
-
-        filenames = []
+            grouped_catalogue = self.catalogue.group_by(
+                ["PETAL_LOC", "TILEID", "NIGHT"])
+            catalogue_by_petal_tile_night = {
+                f"{group['PETAL_LOC'][0]}-{group['TILEID'][0]}-"
+                f"{group['NIGHT'][0]}": group
+                for group in grouped_catalogue.groups
+            }
+
+        # parse the petal/tile/night combination from the file names and
+        # keep the files with quasars in the catalogue
+        filename_regex = re.compile(
+            rf"{coadd_name}-(\d+-\d+-(?:thru)?\d+)\.fits$")
+        catalogue_by_filename = {}
         forests_by_targetid = {}
         for file_in in files_in:
-            for petal_tile_night in petal_tile_night_unique:
-                if petal_tile_night in os.path.basename(file_in):
-                    filenames.append(file_in)
-        filenames = np.unique(filenames)
+            match = filename_regex.match(os.path.basename(file_in))
+            if (match is not None and
+                    match.group(1) in catalogue_by_petal_tile_night):
+                catalogue_by_filename[file_in] = (
+                    catalogue_by_petal_tile_night[match.group(1)])
+        # files_in is sorted and has no duplicates
+        filenames = list(catalogue_by_filename.keys())
 
         if self.num_processors > 1:
-            arguments = [(filename, self.catalogue) for filename in filenames]
+            arguments = [(filename, catalogue_by_filename[filename])
+                         for filename in filenames]
             context = multiprocessing.get_context('fork')
+            # send the files to the workers in batches to reduce the
+            # inter-process communication overhead
+            chunksize = max(1, len(arguments) // (4 * self.num_processors))
             with context.Pool(processes=self.num_processors) as pool:
                 imap_it = pool.imap(
                     DesiTileFileHandler(self.analysis_type,
                                         self.use_non_coadded_spectra,
                                         self.logger, self.input_directory),
-                    arguments)
+                    arguments,
+                    chunksize=chunksize)
                 for forests_by_targetid_aux, _ in imap_it:
                     # Merge each dict to master forests_by_targetid
                     merge_new_forest(forests_by_targetid,
@@ -109,7 +126,7 @@ class DesiTile(DesiData):
                                          self.logger, self.input_directory)
             for index, filename in enumerate(filenames):
                 forests_by_targetid_aux, num_data_aux = reader(
-                    (filename, self.catalogue))
+                    (filename, catalogue_by_filename[filename]))
                 merge_new_forest(forests_by_targetid, forests_by_targetid_aux)
                 num_data += num_data_aux
                 self.logger.progress(
@@ -192,7 +209,9 @@ class DesiTileFileHandler(DesiDataFileHandler):
             self.logger.warning(f"Error reading file {filename}. Ignoring file")
             return {}, 0
 
-        fibermap = hdul['FIBERMAP'].read()
+        fibermap = hdul['FIBERMAP'].read(columns=[
+            "TARGETID", "TARGET_RA", "TARGET_DEC", "TILEID", "PETAL_LOC"
+        ])
 
         ra = fibermap['TARGET_RA']
         dec = fibermap['TARGET_DEC']
@@ -218,8 +237,11 @@ class DesiTileFileHandler(DesiDataFileHandler):
                 spec = {}
                 spec['WAVELENGTH'] = hdul[f'{color}_WAVELENGTH'].read()
                 spec['FLUX'] = hdul[f'{color}_FLUX'].read()
-                spec['IVAR'] = (hdul[f'{color}_IVAR'].read() *
-                                (hdul[f'{color}_MASK'].read() == 0))
+                spec['IVAR'] = hdul[f'{color}_IVAR'].read()
+                # mask in place to avoid full-size temporary copies
+                np.multiply(spec['IVAR'],
+                            hdul[f'{color}_MASK'].read() == 0,
+                            out=spec['IVAR'])
                 if self.analysis_type == "PK 1D":
                     if f"{color}_RESOLUTION" in hdul:
                         spec["RESO"] = hdul[f"{color}_RESOLUTION"].read()
@@ -229,7 +251,8 @@ class DesiTileFileHandler(DesiDataFileHandler):
                             "{filename}. Analysis type is  'PK 1D', "
                             "but file does not contain HDU "
                             f"'{color}_RESOLUTION' ")
-                w = np.isnan(spec['FLUX']) | np.isnan(spec['IVAR'])
+                w = np.isnan(spec['FLUX'])
+                w |= np.isnan(spec['IVAR'])
                 for key in ['FLUX', 'IVAR']:
                     spec[key][w] = 0.
                 spectrographs_data[color] = spec
@@ -13,8 +13,8 @@ from picca.delta_extraction.expected_fluxes.dr16_fixed_varlss_expected_flux impo
     defaults as defaults3, accepted_options as accepted_options3)
 from picca.delta_extraction.utils import update_accepted_options, update_default_options
 
-accepted_options = update_accepted_options(accepted_options, accepted_options2)
-accepted_options = update_accepted_options(accepted_options, accepted_options3)
+accepted_options = update_accepted_options(
+    accepted_options, accepted_options2 + accepted_options3)
 accepted_options = update_accepted_options(accepted_options, [
     "limit var lss", "num iterations", "use constant weight",
     "use ivar as weight"
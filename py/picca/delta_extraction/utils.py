@@ -295,10 +295,10 @@ def update_accepted_options(accepted_options, new_options, remove=False):
     The updated accepted options
     """
     if remove:
-        accepted_options = accepted_options.copy()
-        for item in new_options:
-            if item in accepted_options:
-                accepted_options.remove(item)
+        new_options = set(new_options)
+        accepted_options = [
+            item for item in accepted_options if item not in new_options
+        ]
     else:
         accepted_options = sorted(list(set(accepted_options + new_options)))
 
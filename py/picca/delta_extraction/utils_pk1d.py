@@ -9,7 +9,7 @@ This module provides three functions:
 See the respective documentation for details
 """
 import logging
-import warnings
+import math
 import numpy as np
 from numba import njit
 
@@ -18,6 +18,127 @@ from picca.delta_extraction.utils import SPEED_LIGHT
 # create logger
 module_logger = logging.getLogger(__name__)
 
+# conversion from a log10 wavelength interval to a velocity interval (in km/s)
+LOG10_LAMBDA_TO_KM_PER_S = SPEED_LIGHT * np.log(10.)
+# size of an SDSS pixel (1e-4 in log10 wavelength) in km/s
+SDSS_PIXEL_IN_KM_PER_S = LOG10_LAMBDA_TO_KM_PER_S * 1.0e-4
+
+
+@njit
+def _find_bin(log_lambda, value, log_lambda_min, delta_log_lambda):
+    """Find the index where value would be inserted in log_lambda to keep it
+    sorted, i.e. same as np.searchsorted(log_lambda, value)
+
+    The position expected for a uniform grid is used as a first guess and then
+    corrected by looking at its neighbours, so that the search is O(1) for
+    the usual log-uniform grids. Far-off guesses fall back to a binary search.
+
+    Arguments
+    ---------
+    log_lambda: array of float
+    Logarithm of the wavelengths of the grid (in Angs), sorted
+
+    value: float
+    Logarithm of the wavelength to look for (in Angs)
+
+    log_lambda_min: float
+    First value of log_lambda
+
+    delta_log_lambda: float
+    Mean spacing of log_lambda
+
+    Return
+    ------
+    index: int
+    The insertion index
+    """
+    num_bins = log_lambda.size
+    if np.isnan(value):
+        return np.searchsorted(log_lambda, value)
+    guess = np.ceil((value - log_lambda_min) / delta_log_lambda)
+    index = int(min(max(guess, 0.0), num_bins))
+    for _ in range(2):
+        if index > 0 and log_lambda[index - 1] >= value:
+            index -= 1
+        elif index < num_bins and log_lambda[index] < value:
+            index += 1
+        else:
+            return index
+    return np.searchsorted(log_lambda, value)
+
+
+@njit
+def _rebin_exposures(log_lambda, log_lambda_exp, flux_exp, ivar_exp, mask,
+                     num_pixels_exp):
+    """Rebin the exposures onto a wavelength grid, accumulating separately the
+    even-number and the odd-number exposures
+
+    Exposures are stored column by column for each exposure index. Pixels
+    with mask 25 (COMBINEREJ) are given a zero weight and the last populated
+    bin of each exposure is discarded.
+
+    Arguments
+    ---------
+    log_lambda: array of float
+    Logarithm of the wavelengths of the grid (in Angs)
+
+    log_lambda_exp: array of float
+    Concatenated logarithm of the wavelengths of the exposures (in Angs)
+
+    flux_exp: array of float
+    Concatenated flux of the exposures
+
+    ivar_exp: array of float
+    Concatenated inverse variance of the exposures
+
+    mask: array of int
+    Concatenated mask of the exposures
+
+    num_pixels_exp: array of int
+    Number of pixels of each exposure
+
+    Return
+    ------
+    flux_total: 2D array of float
+    Weighted flux of the even (first row) and odd (second row) exposures
+
+    ivar_total: 2D array of float
+    Inverse variance of the even (first row) and odd (second row) exposures
+    """
+    flux_total = np.zeros((2, log_lambda.size))
+    ivar_total = np.zeros((2, log_lambda.size))
+    # mean spacing of the grid, used to guess the bins
+    log_lambda_min = 0.0
+    delta_log_lambda = 1.0
+    if log_lambda.size > 1 and log_lambda[-1] > log_lambda[0]:
+        log_lambda_min = log_lambda[0]
+        delta_log_lambda = ((log_lambda[-1] - log_lambda[0]) /
+                            (log_lambda.size - 1))
+    start = 0
+    for index, num_pixels in enumerate(num_pixels_exp):
+        end = start + num_pixels
+        parity = (index // 2) % 2
+        log_lambda_bins = np.empty(num_pixels, dtype=np.int64)
+        for pixel in range(start, end):
+            log_lambda_bins[pixel - start] = _find_bin(log_lambda,
+                                                       log_lambda_exp[pixel],
+                                                       log_lambda_min,
+                                                       delta_log_lambda)
+        max_bin = -1
+        if num_pixels > 0:
+            max_bin = log_lambda_bins.max()
+        for pixel in range(start, end):
+            log_lambda_bin = log_lambda_bins[pixel - start]
+            if log_lambda_bin == max_bin:
+                continue
+            # exclude masks 25 (COMBINEREJ), 23 (BRIGHTSKY)?
+            ivar_weight = ivar_exp[pixel] * (mask[pixel] & 2**25 == 0)
+            flux_total[parity, log_lambda_bin] += ivar_weight * flux_exp[pixel]
+            ivar_total[parity, log_lambda_bin] += ivar_weight
+        start = end
+
+    return flux_total, ivar_total
+
 
 def exp_diff(hdul, log_lambda):
     """Compute the difference between exposures.
@@ -41,51 +162,56 @@ def exp_diff(hdul, log_lambda):
     The difference between exposures
     """
     num_exp_per_col = hdul[0].read_header()['NEXP'] // 2
-    flux_total_odd = np.zeros(log_lambda.size)
-    ivar_total_odd = np.zeros(log_lambda.size)
-    flux_total_even = np.zeros(log_lambda.size)
-    ivar_total_even = np.zeros(log_lambda.size)
 
+    # without exposures there is nothing to rebin, and with one exposure per
+    # column alpha is zero: the difference is zero in both cases
     if num_exp_per_col < 2:
         module_logger.debug("Not enough exposures for diff")
-
-    for index_exp in range(num_exp_per_col):
-        for index_col in range(2):
-            log_lambda_exp = hdul[(4 + index_exp +
-                                   index_col * num_exp_per_col)]["loglam"][:]
-            flux_exp = hdul[(4 + index_exp +
-                             index_col * num_exp_per_col)]["flux"][:]
-            ivar_exp = hdul[(4 + index_exp +
-                             index_col * num_exp_per_col)]["ivar"][:]
-            mask = hdul[4 + index_exp + index_col * num_exp_per_col]["mask"][:]
-            log_lambda_bins = np.searchsorted(log_lambda, log_lambda_exp)
-
-            # exclude masks 25 (COMBINEREJ), 23 (BRIGHTSKY)?
-            rebin_ivar_exp = np.bincount(log_lambda_bins,
-                                         weights=ivar_exp * (mask & 2**25 == 0))
-            rebin_flux_exp = np.bincount(log_lambda_bins,
-                                         weights=(ivar_exp * flux_exp *
-                                                  (mask & 2**25 == 0)))
-
-            if index_exp % 2 == 1:
-                flux_total_odd[:len(rebin_ivar_exp) - 1] += rebin_flux_exp[:-1]
-                ivar_total_odd[:len(rebin_ivar_exp) - 1] += rebin_ivar_exp[:-1]
-            else:
-                flux_total_even[:len(rebin_ivar_exp) - 1] += rebin_flux_exp[:-1]
-                ivar_total_even[:len(rebin_ivar_exp) - 1] += rebin_ivar_exp[:-1]
-
-    w = ivar_total_odd > 0
-    flux_total_odd[w] /= ivar_total_odd[w]
-    w = ivar_total_even > 0
-    flux_total_even[w] /= ivar_total_even[w]
+        return np.zeros(log_lambda.size)
+
+    # gather all the exposures so that they are rebinned at once
+    # each exposure HDU is looked up once and its columns are read together
+    # (the column names may be upper case in the spec files)
+    exposures = [
+        hdul[4 + index_exp + index_col * num_exp_per_col].read(
+            columns=["loglam", "flux", "ivar", "mask"], lower=True)
+        for index_exp in range(num_exp_per_col)
+        for index_col in range(2)
+    ]
+
+    num_pixels_exp = np.array([exposure.size for exposure in exposures])
+    # concatenate the records once (in native byte order for numba)
+    exposures = np.concatenate(exposures)
+    exposures = exposures.astype(exposures.dtype.newbyteorder("="), copy=False)
+    flux_total, ivar_total = _rebin_exposures(log_lambda,
+                                              exposures["loglam"],
+                                              exposures["flux"],
+                                              exposures["ivar"],
+                                              exposures["mask"],
+                                              num_pixels_exp)
+    flux_total_even, flux_total_odd = flux_total
+    ivar_total_even, ivar_total_odd = ivar_total
+
+    np.divide(flux_total_odd,
+              ivar_total_odd,
+              out=flux_total_odd,
+              where=ivar_total_odd > 0)
+    np.divide(flux_total_even,
+              ivar_total_even,
+              out=flux_total_even,
+              where=ivar_total_even > 0)
 
     alpha = 1
     if num_exp_per_col % 2 == 1:
         num_even_exp = (num_exp_per_col - 1) // 2
-        alpha = np.sqrt(4. * num_even_exp *
-                        (num_even_exp + 1)) / num_exp_per_col
+        alpha = math.sqrt(4. * num_even_exp *
+                          (num_even_exp + 1)) / num_exp_per_col
     # TODO: CHECK THE * alpha (Nathalie)
-    exposures_diff = 0.5 * (flux_total_even - flux_total_odd) * alpha
+    # the even total is not needed anymore, reuse its buffer
+    exposures_diff = np.subtract(flux_total_even,
+                                 flux_total_odd,
+                                 out=flux_total_even)
+    exposures_diff *= 0.5 * alpha
 
     return exposures_diff
 
@@ -106,17 +232,14 @@ def exp_diff_desi(spec_dict, mask_targetid):
     Returns:
         The difference between exposures
     """
-    ivar_unsorted = np.atleast_2d(spec_dict["IVAR"][mask_targetid])
-    num_exp = ivar_unsorted.shape[0]
-
-    # Putting the lowest ivar exposure at the end if the number of exposures is odd
-    argsort = np.arange(num_exp)
-    if num_exp % 2 == 1:
-        argmin_ivar = np.argmin(np.mean(ivar_unsorted, axis=1))
-        argsort[-1], argsort[argmin_ivar] = argsort[argmin_ivar], argsort[-1]
-
-    flux = np.atleast_2d(spec_dict["FLUX"][mask_targetid])[argsort, :]
-    ivar = ivar_unsorted[argsort, :]
+    # convert the selection to row indices so that each array is gathered
+    # only once, already in the final exposure order
+    rows = np.atleast_1d(mask_targetid)
+    if rows.dtype == bool:
+        rows = np.flatnonzero(rows)
+    num_exp = rows.size
+
+    # reject the spectra before selecting and sorting the flux
     if num_exp < 2:
         module_logger.debug("Not enough exposures for diff, Spectra rejected")
         return None
@@ -125,35 +248,47 @@ def exp_diff_desi(spec_dict, mask_targetid):
                             "type and using wavelength axis here, skipping?")
         return None
 
+    ivar = spec_dict["IVAR"][rows]
+
+    # Putting the lowest ivar exposure at the end if the number of exposures is odd
+    if num_exp % 2 == 1:
+        argsort = np.arange(num_exp)
+        argmin_ivar = np.argmin(np.mean(ivar, axis=1))
+        argsort[-1], argsort[argmin_ivar] = argsort[argmin_ivar], argsort[-1]
+        rows = rows[argsort]
+        ivar = ivar[argsort, :]
+
+    flux = spec_dict["FLUX"][rows]
+
     # Computing ivar and flux for odd and even exposures
-    ivar_total = np.zeros(flux.shape[1])
-    flux_total_odd = np.zeros(flux.shape[1])
-    ivar_total_odd = np.zeros(flux.shape[1])
-    flux_total_even = np.zeros(flux.shape[1])
-    ivar_total_even = np.zeros(flux.shape[1])
-    for index_exp in range(2 * (num_exp // 2)):
-        flexp = flux[index_exp]
-        ivexp = ivar[index_exp]
-        if index_exp % 2 == 1:
-            flux_total_odd += flexp * ivexp
-            ivar_total_odd += ivexp
-        else:
-            flux_total_even += flexp * ivexp
-            ivar_total_even += ivexp
+    # (the totals are accumulated in double precision)
+    even_exps = slice(0, 2 * (num_exp // 2), 2)
+    odd_exps = slice(1, 2 * (num_exp // 2), 2)
+    flux_total_odd = (flux[odd_exps] * ivar[odd_exps]).sum(axis=0,
+                                                           dtype=np.float64)
+    ivar_total_odd = ivar[odd_exps].sum(axis=0, dtype=np.float64)
+    flux_total_even = (flux[even_exps] * ivar[even_exps]).sum(axis=0,
+                                                              dtype=np.float64)
+    ivar_total_even = ivar[even_exps].sum(axis=0, dtype=np.float64)
     ivar_total = ivar.sum(axis=0)
 
     # Masking and dividing flux by ivar
     w_odd = ivar_total_odd > 0
-    flux_total_odd[w_odd] /= ivar_total_odd[w_odd]
+    np.divide(flux_total_odd, ivar_total_odd, out=flux_total_odd, where=w_odd)
     w_even = ivar_total_even > 0
-    flux_total_even[w_even] /= ivar_total_even[w_even]
+    np.divide(flux_total_even,
+              ivar_total_even,
+              out=flux_total_even,
+              where=w_even)
 
     # Computing alpha correction
     w = w_odd & w_even & (ivar_total > 0)
     alpha_array = np.ones(flux.shape[1])
     alpha_array[w] = (1 / np.sqrt(ivar_total[w])) / (0.5 * np.sqrt(
         (1 / ivar_total_even[w]) + (1 / ivar_total_odd[w])))
-    diff = 0.5 * (flux_total_even - flux_total_odd) * alpha_array
+    diff = np.subtract(flux_total_even, flux_total_odd, out=flux_total_even)
+    diff *= 0.5
+    diff *= alpha_array
     return diff
 
 
@@ -184,23 +319,29 @@ def spectral_resolution(wdisp,
     reso: array of floats
     The spectral resolution
     """
-    reso = wdisp * SPEED_LIGHT * 1.0e-4 * np.log(10.)
+    reso = wdisp * SDSS_PIXEL_IN_KM_PER_S
 
     if with_correction:
-        lambda_ = np.power(10., log_lambda)
+        # 10**log_lambda, exp2 is much faster than the generic power
+        lambda_ = np.exp2(log_lambda * math.log2(10.))
         # compute the wavelength correction
-        correction = 1.267 - 0.000142716 * lambda_ + 1.9068e-08 * lambda_ * lambda_
-        correction[lambda_ > 6000.0] = 1.097
+        correction = np.where(
+            lambda_ > 6000.0, 1.097,
+            1.267 + lambda_ * (-0.000142716 + 1.9068e-08 * lambda_))
 
         # add the fiberid correction
         # fiberids greater than 500 corresponds to the second spectrograph
+        # the fiberid only rescales the departure of the correction from 1
         fiberid = fiberid % 500
         if fiberid < 100:
-            correction = (1. + (correction - 1) * .25 + (correction - 1) * .75 *
-                          (fiberid) / 100.)
+            fiberid_factor = .25 + .75 * (fiberid) / 100.
         elif fiberid > 400:
-            correction = (1. + (correction - 1) * .25 + (correction - 1) * .75 *
-                          (500 - fiberid) / 100.)
+            fiberid_factor = .25 + .75 * (500 - fiberid) / 100.
+        else:
+            fiberid_factor = 1.
+        correction -= 1.
+        correction *= fiberid_factor
+        correction += 1.
 
         # apply the correction
         reso *= correction
@@ -286,12 +427,10 @@ def spectral_resolution_desi(reso_matrix, lambda_):
     #   A = reso(central_pixel_pos)
     # the following averages over estimates for four symmetric values of x
     indices = np.array([-2, -1, 1, 2], dtype=int)
-    with warnings.catch_warnings():
-        # this ignores all warnings in this part of the code, could in principle
-        # specify the exact warnings to be supressed
-        warnings.filterwarnings(
-            'ignore'
-        )
+    # the floating point errors from the degenerate diagonals are discarded
+    # below; silencing them with errstate avoids going through the warnings
+    # machinery on every call
+    with np.errstate(all='ignore'):
         ratios = reso[num_offdiags, :] / reso[num_offdiags + indices, :]
         ratios = np.log(ratios)
         w2 = ratios > 0
@@ -301,10 +440,10 @@ def spectral_resolution_desi(reso_matrix, lambda_):
         # ratios = 1./np.sqrt(np.log(ratios))
 
         rms_in_pixel = np.empty_like(lambda_)
-        rms_in_pixel[w] = np.abs(indices).dot(new_ratios) / np.sqrt(2.) / norm
+        rms_in_pixel[w] = np.abs(indices).dot(new_ratios) / math.sqrt(2.) / norm
         rms_in_pixel[~w] = rms_in_pixel[w].mean()
 
-        reso_in_km_per_s = (rms_in_pixel * SPEED_LIGHT * delta_log_lambda *
-                            np.log(10.0))  #this is FWHM
+        reso_in_km_per_s = (rms_in_pixel * LOG10_LAMBDA_TO_KM_PER_S *
+                            delta_log_lambda)  #this is FWHM
 
     return rms_in_pixel, reso_in_km_per_s
@@ -5,6 +5,8 @@ This module several functions to read different types of data:
     - read_drq
     - read_blinding
     - read_delta_file
+    - compute_z_and_rescale_weights
+    - read_and_project_delta_file
     - read_deltas
     - read_objects
 See the respective documentation for details
@@ -14,12 +16,14 @@ import sys
 import time
 import os.path
 import copy
+import functools
 import numpy as np
 import healpy
 import fitsio
 from astropy.table import Table
 import warnings
 from multiprocessing import Pool
+from numba import njit
 
 from .utils import userprint
 from .data import Delta, QSO
@@ -290,6 +294,101 @@ def read_delta_file(filename, z_min_qso=0, z_max_qso=10, rebin_factor=None):
     return deltas
 
 
+@njit
+def compute_z_and_rescale_weights(log_lambda, weights, lambda_abs, alpha,
+                                  z_ref):
+    """Computes the redshifts of the absorbers and rescales the weights.
+
+    The weights are multiplied in place by
+        `(1+z)^(alpha-1)/(1+z_ref)^(alpha-1)`
+    (equation 7 of du Mas des Bourboux et al. 2020)
+
+    Args:
+        log_lambda: array of float
+            Logarithm of the wavelength (in Angstroms)
+        weights: array of float
+            Weights associated to each pixel. Modified in place.
+        lambda_abs: float
+            Wavelength of the absorption (in Angstroms)
+        alpha: float
+            Redshift evolution coefficient
+        z_ref: float
+            Redshift of reference
+
+    Returns:
+        The redshift of each pixel
+    """
+    z = np.empty_like(log_lambda)
+    for index in range(log_lambda.size):
+        z[index] = 10**log_lambda[index] / lambda_abs - 1.
+        weights[index] *= ((1. + z[index]) / (1. + z_ref))**(alpha - 1.)
+    return z
+
+
+def read_and_project_delta_file(filename,
+                                lambda_abs,
+                                alpha,
+                                z_ref,
+                                no_project=False,
+                                z_min_qso=0,
+                                z_max_qso=10,
+                                rebin_factor=None):
+    """Extracts deltas from a single file, computes their redshifts,
+    rescales their weights and projects them.
+
+    This is meant to be run by the workers of read_deltas so that the
+    per-forest computations are distributed together with the reading.
+
+    Args:
+        filename: str
+            Path to the file to read
+        lambda_abs: float
+            Wavelength of the absorption (in Angstroms)
+        alpha: float
+            Redshift evolution coefficient (see equation 7 of du Mas des
+            Bourboux et al. 2020)
+        z_ref: float
+            Redshift of reference
+        no_project: bool - default: False
+            If False, project the deltas (see equation 5 of du Mas des
+            Bourboux et al. 2020)
+        z_min_qso: float - default: 0
+            Specifies the minimum redshift for QSOs
+        z_max_qso: float - default: 10
+            Specifies the maximum redshift for QSOs
+        rebin_factor: int - default: None
+            Factor to rebin the lambda grid by. If None, no rebinning is done.
+
+    Returns:
+        deltas: list of Delta
+            The deltas in the file
+    """
+    deltas = read_delta_file(filename,
+                             z_min_qso=z_min_qso,
+                             z_max_qso=z_max_qso,
+                             rebin_factor=rebin_factor)
+    if deltas is None or len(deltas) == 0:
+        return deltas
+
+    # compute the redshifts and rescale the weights of all the deltas in a
+    # single pass over the concatenated arrays
+    split_indexs = np.cumsum([delta.log_lambda.size for delta in deltas])[:-1]
+    log_lambda = np.concatenate([delta.log_lambda for delta in deltas])
+    weights = np.concatenate([delta.weights for delta in deltas])
+    z = compute_z_and_rescale_weights(log_lambda, weights, lambda_abs, alpha,
+                                      z_ref)
+
+    for delta, z_delta, weights_delta in zip(deltas,
+                                             np.split(z, split_indexs),
+                                             np.split(weights, split_indexs)):
+        delta.z = z_delta
+        delta.weights = weights_delta
+        if not no_project:
+            delta.project()
+
+    return deltas
+
+
 def read_deltas(in_dir,
                 nside,
                 lambda_abs,
@@ -363,19 +462,32 @@ def read_deltas(in_dir,
     if rebin_factor is not None:
         userprint(f"Rebinning deltas by a factor of {rebin_factor}\n")
 
-    arguments = [(f, z_min_qso, z_max_qso, rebin_factor) for f in files]
-    pool = Pool(processes=nproc)
-    results = pool.starmap(read_delta_file, arguments)
-    pool.close()
-
+    # read the files in parallel; the workers also compute the redshifts,
+    # rescale the weights and project the deltas. imap keeps the file
+    # ordering and the chunksize amortizes the per-task overhead over several
+    # files
+    reader = functools.partial(read_and_project_delta_file,
+                               lambda_abs=lambda_abs,
+                               alpha=alpha,
+                               z_ref=z_ref,
+                               no_project=no_project,
+                               z_min_qso=z_min_qso,
+                               z_max_qso=z_max_qso,
+                               rebin_factor=rebin_factor)
+    num_processes = nproc if nproc is not None else os.cpu_count()
+    chunksize = max(1, len(files) // (4 * num_processes))
+    # the results are consumed as they arrive so that, once max_num_spec
+    # lines of sight have been loaded, leaving the with block terminates the
+    # pool and the remaining files are not read
     deltas = []
     num_data = 0
-    for delta in results:
-        if delta is not None:
-            deltas += delta
-            num_data = len(deltas)
-            if (max_num_spec is not None) and (num_data > max_num_spec):
-                break
+    with Pool(processes=nproc) as pool:
+        for delta in pool.imap(reader, files, chunksize=chunksize):
+            if delta is not None:
+                deltas += delta
+                num_data = len(deltas)
+                if (max_num_spec is not None) and (num_data >= max_num_spec):
+                    break
 
     # truncate the deltas if we load too many lines of sight
     if max_num_spec is not None:
@@ -385,31 +497,42 @@ def read_deltas(in_dir,
     userprint("\n")
 
     # compute healpix numbers
-    phi = [delta.ra for delta in deltas]
-    theta = [np.pi / 2. - delta.dec for delta in deltas]
+    phi = np.fromiter((delta.ra for delta in deltas),
+                      dtype=np.float64,
+                      count=len(deltas))
+    theta = np.pi / 2. - np.fromiter((delta.dec for delta in deltas),
+                                     dtype=np.float64,
+                                     count=len(deltas))
     healpixs = healpy.ang2pix(nside, theta, phi)
     if healpixs.size == 0:
         raise AssertionError('ERROR: No data in {}'.format(in_dir))
 
+    split_indexs = np.cumsum([delta.z.size for delta in deltas])[:-1]
+    z = np.concatenate([delta.z for delta in deltas])
+    z_min = z.min()
+    z_max = max(0., z.max())
+
+    # interpolate the distances of all the deltas at once instead of
+    # calling the interpolators once per delta
+    if not cosmo is None:
+        for delta, r_comov, dist_m in zip(
+                deltas, np.split(cosmo.get_r_comov(z), split_indexs),
+                np.split(cosmo.get_dist_m(z), split_indexs)):
+            delta.r_comov = r_comov
+            delta.dist_m = dist_m
+
+    # group deltas by healpix with a single sort. The stable sort keeps the
+    # reading order within each healpix, and healpixs are inserted in the
+    # dictionary in order of first appearance
+    sort_indexs = np.argsort(healpixs, kind="stable")
+    unique_healpixs, start_indexs = np.unique(healpixs[sort_indexs],
+                                              return_index=True)
+    healpixs_indexs = np.split(sort_indexs, start_indexs[1:])
     data = {}
-    z_min = 10**deltas[0].log_lambda[0] / lambda_abs - 1.
-    z_max = 0.
-    for delta, healpix in zip(deltas, healpixs):
-        z = 10**delta.log_lambda / lambda_abs - 1.
-        z_min = min(z_min, z.min())
-        z_max = max(z_max, z.max())
-        delta.z = z
-        if not cosmo is None:
-            delta.r_comov = cosmo.get_r_comov(z)
-            delta.dist_m = cosmo.get_dist_m(z)
-        delta.weights *= ((1 + z) / (1 + z_ref))**(alpha - 1)
-
-        if not no_project:
-            delta.project()
-
-        if not healpix in data:
-            data[healpix] = []
-        data[healpix].append(delta)
+    for group_index in np.argsort([indexs[0] for indexs in healpixs_indexs]):
+        data[unique_healpixs[group_index]] = [
+            deltas[index] for index in healpixs_indexs[group_index]
+        ]
 
     return data, num_data, z_min, z_max
 
@@ -7,9 +7,15 @@ This module provides three functions:
     - spectral_resolution_desi
 See the respective documentation for details
 """
+import math
 import numpy as np
+from numba import njit
 
-from picca.constants import SPEED_LIGHT
+from picca.delta_extraction import utils_pk1d
+from picca.delta_extraction.utils_pk1d import (
+    LOG10_LAMBDA_TO_KM_PER_S,
+    SDSS_PIXEL_IN_KM_PER_S,
+)
 from picca.utils import userprint
 
 
@@ -34,53 +40,10 @@ def exp_diff(hdul, log_lambda):
     exposure_diff: array of float
     The difference between exposures
     """
-    num_exp_per_col = hdul[0].read_header()["NEXP"] // 2
-    flux_total_odd = np.zeros(log_lambda.size)
-    ivar_total_odd = np.zeros(log_lambda.size)
-    flux_total_even = np.zeros(log_lambda.size)
-    ivar_total_even = np.zeros(log_lambda.size)
-
-    if num_exp_per_col < 2:
+    if hdul[0].read_header()["NEXP"] // 2 < 2:
         userprint("DBG : not enough exposures for diff")
 
-    for index_exp in range(num_exp_per_col):
-        for index_col in range(2):
-            log_lambda_exp = hdul[(4 + index_exp + index_col * num_exp_per_col)][
-                "loglam"
-            ][:]
-            flux_exp = hdul[(4 + index_exp + index_col * num_exp_per_col)]["flux"][:]
-            ivar_exp = hdul[(4 + index_exp + index_col * num_exp_per_col)]["ivar"][:]
-            mask = hdul[4 + index_exp + index_col * num_exp_per_col]["mask"][:]
-            log_lambda_bins = np.searchsorted(log_lambda, log_lambda_exp)
-
-            # exclude masks 25 (COMBINEREJ), 23 (BRIGHTSKY)?
-            rebin_ivar_exp = np.bincount(
-                log_lambda_bins, weights=ivar_exp * (mask & 2**25 == 0)
-            )
-            rebin_flux_exp = np.bincount(
-                log_lambda_bins, weights=(ivar_exp * flux_exp * (mask & 2**25 == 0))
-            )
-
-            if index_exp % 2 == 1:
-                flux_total_odd[: len(rebin_ivar_exp) - 1] += rebin_flux_exp[:-1]
-                ivar_total_odd[: len(rebin_ivar_exp) - 1] += rebin_ivar_exp[:-1]
-            else:
-                flux_total_even[: len(rebin_ivar_exp) - 1] += rebin_flux_exp[:-1]
-                ivar_total_even[: len(rebin_ivar_exp) - 1] += rebin_ivar_exp[:-1]
-
-    w = ivar_total_odd > 0
-    flux_total_odd[w] /= ivar_total_odd[w]
-    w = ivar_total_even > 0
-    flux_total_even[w] /= ivar_total_even[w]
-
-    alpha = 1
-    if num_exp_per_col % 2 == 1:
-        num_exp_even = (num_exp_per_col - 1) // 2
-        alpha = np.sqrt(4.0 * num_exp_even * (num_exp_even + 1)) / num_exp_per_col
-    # TODO: CHECK THE * alpha (Nathalie)
-    exposures_diff = 0.5 * (flux_total_even - flux_total_odd) * alpha
-
-    return exposures_diff
+    return utils_pk1d.exp_diff(hdul, log_lambda)
 
 
 def exp_diff_desi(
@@ -115,13 +78,14 @@ def exp_diff_desi(
     diff: array of float
     The difference between exposures
     """
-    argsort = np.flip(np.argsort(np.mean(file["IV"][mask_targetid], axis=1)))
-
-    teff_lya = file["TEFF_LYA"][mask_targetid][argsort]
-    flux = file["FL"][mask_targetid][argsort, :]
-    ivar = file["IV"][mask_targetid][argsort, :]
-
-    num_exp = len(flux)
+    # convert the selection to row indices so that each array is gathered
+    # only once, already in the final exposure order
+    rows = np.atleast_1d(mask_targetid)
+    if rows.dtype == bool:
+        rows = np.flatnonzero(rows)
+
+    # reject the spectra before selecting and sorting the flux
+    num_exp = rows.size
     if num_exp < 2:
         print("Not enough exposures for diff, spectra rejected")
         return None
@@ -130,22 +94,31 @@ def exp_diff_desi(
             print("Odd number of exposures discarded")
             return None
 
+    ivar = file["IV"][rows]
+    argsort = np.flip(np.argsort(np.mean(ivar, axis=1)))
+    rows = rows[argsort]
+
+    teff_lya = file["TEFF_LYA"][rows]
+    flux = file["FL"][rows]
+    ivar = ivar[argsort, :]
+
     time_even = 0
     time_odd = 0
     time_exp = np.sum(teff_lya)
 
     even_inds = slice(0, 2 * (num_exp // 2), 2)
     odd_inds = slice(1, 2 * (num_exp // 2), 2)
-    flux_tot_odd = (flux[odd_inds] * ivar[odd_inds]).sum(axis=0)
+    # einsum fuses the product and the sum over exposures
+    flux_tot_odd = np.einsum("ij,ij->j", flux[odd_inds], ivar[odd_inds])
     ivar_tot_odd = (ivar[odd_inds]).sum(axis=0)
-    flux_tot_even = (flux[even_inds] * ivar[even_inds]).sum(axis=0)
+    flux_tot_even = np.einsum("ij,ij->j", flux[even_inds], ivar[even_inds])
     ivar_tot_even = (ivar[even_inds]).sum(axis=0)
     ivar_tot = ivar[:num_exp].sum(axis=0)
 
     mask_odd = ivar_tot_odd > 0
-    flux_tot_odd[mask_odd] /= ivar_tot_odd[mask_odd]
+    np.divide(flux_tot_odd, ivar_tot_odd, out=flux_tot_odd, where=mask_odd)
     mask_even = ivar_tot_even > 0
-    flux_tot_even[mask_even] /= ivar_tot_even[mask_even]
+    np.divide(flux_tot_even, ivar_tot_even, out=flux_tot_even, where=mask_even)
 
     if method_alpha == "eboss":
         alpha = 1
@@ -181,7 +154,11 @@ def exp_diff_desi(
             (time_odd * time_even) / (time_exp * (time_odd + time_even))
         )
 
-    diff = 0.5 * (flux_tot_even - flux_tot_odd) * alpha
+    # the even total is not needed anymore, reuse its buffer (the product with
+    # alpha is not done in place to keep the dtype promotion)
+    diff = np.subtract(flux_tot_even, flux_tot_odd, out=flux_tot_even)
+    diff *= 0.5
+    diff = diff * alpha
     return diff
 
 
@@ -214,29 +191,31 @@ def spectral_resolution(
     reso: array of float
     The spectral resolution
     """
-    reso = wdisp * SPEED_LIGHT * 1.0e-4 * np.log(10.0)
+    reso = wdisp * SDSS_PIXEL_IN_KM_PER_S
 
     if with_correction:
-        lambda_ = np.power(10.0, log_lambda)
+        # 10**log_lambda, exp2 is much faster than the generic power
+        lambda_ = np.exp2(log_lambda * math.log2(10.0))
         # compute the wavelength correction
-        correction = 1.267 - 0.000142716 * lambda_ + 1.9068e-08 * lambda_ * lambda_
-        correction[lambda_ > 6000.0] = 1.097
+        correction = np.where(
+            lambda_ > 6000.0,
+            1.097,
+            1.267 + lambda_ * (-0.000142716 + 1.9068e-08 * lambda_),
+        )
 
         # add the fiberid correction
         # fiberids greater than 500 corresponds to the second spectrograph
+        # the fiberid only rescales the departure of the correction from 1
         fiberid = fiberid % 500
         if fiberid < 100:
-            correction = (
-                1.0
-                + (correction - 1) * 0.25
-                + (correction - 1) * 0.75 * (fiberid) / 100.0
-            )
+            fiberid_factor = 0.25 + 0.75 * (fiberid) / 100.0
         elif fiberid > 400:
-            correction = (
-                1.0
-                + (correction - 1) * 0.25
-                + (correction - 1) * 0.75 * (500 - fiberid) / 100.0
-            )
+            fiberid_factor = 0.25 + 0.75 * (500 - fiberid) / 100.0
+        else:
+            fiberid_factor = 1.0
+        correction -= 1.0
+        correction *= fiberid_factor
+        correction += 1.0
 
         # apply the correction
         reso *= correction
@@ -244,6 +223,64 @@ def spectral_resolution(
     return reso
 
 
+@njit
+def _gaussian_width(central_value, value, distance):
+    """Compute the width of a Gaussian from its central value and its value at
+    a given distance from the center
+
+    Arguments
+    ---------
+    central_value: float
+    Value at the center of the Gaussian
+
+    value: float
+    Value at the given distance
+
+    distance: float
+    Distance to the center (in pixels)
+
+    Return
+    ------
+    sigma: float
+    The Gaussian width (in pixels). Inf if both values are equal and nan if
+    the value is larger than the central value.
+    """
+    log_ratio = np.log(central_value / value)
+    if log_ratio == 0.0:
+        return np.inf
+    return np.sqrt(distance * distance / 2.0 / log_ratio)
+
+
+@njit
+def _rms_in_pixel(reso):
+    """Compute the resolution rms (in pixels) of each wavelength bin from the
+    resolution matrix, assuming a Gaussian profile. The four estimates from the
+    diagonals at distances 1 and 2 from the central one are averaged in a
+    single pass
+
+    Arguments
+    ---------
+    reso: 2D array of float
+    Five central diagonals of the clipped resolution matrix
+
+    Return
+    ------
+    rms_in_pixel: array of float
+    The spectral resolution
+    """
+    mid = reso.shape[0] // 2
+    rms_in_pixel = np.empty(reso.shape[1])
+    for index in range(reso.shape[1]):
+        central_value = reso[mid, index]
+        rms_in_pixel[index] = (
+            _gaussian_width(central_value, reso[mid - 1, index], 1.0)
+            + _gaussian_width(central_value, reso[mid - 2, index], 2.0)
+            + _gaussian_width(central_value, reso[mid + 1, index], 1.0)
+            + _gaussian_width(central_value, reso[mid + 2, index], 2.0)
+        ) / 4.0
+    return rms_in_pixel
+
+
 def spectral_resolution_desi(reso_matrix, log_lambda):
     """Compute the spectral resolution for DESI spectra
     Note that this is only giving rough estimates, it relies on a Gaussian resolution matrix
@@ -265,24 +302,13 @@ def spectral_resolution_desi(reso_matrix, log_lambda):
     The average resolution in km/s
     """
     delta_log_lambda = (log_lambda[-1] - log_lambda[0]) / float(len(log_lambda) - 1)
-    reso = np.clip(reso_matrix, 1.0e-6, 1.0e6)
+    # only the five central diagonals are used, clip them as a single
+    # contiguous block
+    mid = len(reso_matrix) // 2
+    reso = np.clip(reso_matrix[mid - 2 : mid + 3], 1.0e-6, 1.0e6)
 
-    #
-    rms_in_pixel = (
-        np.sqrt(
-            1.0 / 2.0 / np.log(reso[len(reso) // 2][:] / reso[len(reso) // 2 - 1][:])
-        )
-        + np.sqrt(
-            4.0 / 2.0 / np.log(reso[len(reso) // 2][:] / reso[len(reso) // 2 - 2][:])
-        )
-        + np.sqrt(
-            1.0 / 2.0 / np.log(reso[len(reso) // 2][:] / reso[len(reso) // 2 + 1][:])
-        )
-        + np.sqrt(
-            4.0 / 2.0 / np.log(reso[len(reso) // 2][:] / reso[len(reso) // 2 + 2][:])
-        )
-    ) / 4.0
+    rms_in_pixel = _rms_in_pixel(reso)
 
-    avg_reso_in_km_per_s = rms_in_pixel * SPEED_LIGHT * delta_log_lambda * np.log(10.0)
+    avg_reso_in_km_per_s = rms_in_pixel * (LOG10_LAMBDA_TO_KM_PER_S * delta_log_lambda)
 
     return rms_in_pixel, avg_reso_in_km_per_s
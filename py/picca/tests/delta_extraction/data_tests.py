@@ -4,13 +4,14 @@ import logging
 import os
 import unittest
 import copy
+import fitsio
 import numpy as np
 
 from picca.delta_extraction.astronomical_objects.desi_forest import DesiForest
 from picca.delta_extraction.astronomical_objects.desi_pk1d_forest import DesiPk1dForest
 from picca.delta_extraction.astronomical_objects.sdss_forest import SdssForest
 from picca.delta_extraction.config import default_config
-from picca.delta_extraction.data import Data
+from picca.delta_extraction.data import Data, _compress_file
 from picca.delta_extraction.data import defaults as defaults_data
 from picca.delta_extraction.data import accepted_analysis_type, accepted_save_format
 from picca.delta_extraction.data_catalogues.desi_data import DesiData
@@ -45,6 +46,7 @@ class DataTest(AbstractTest):
     compare_ascii (from AbstractTest)
     compare_fits (from AbstractTest)
     setUp (from AbstractTest)
+    test_compress_file
     test_data
     test_data_filter_forests
     test_desi_data
@@ -87,6 +89,27 @@ class DataTest(AbstractTest):
             setup_test_logger("picca.delta_extraction.data.Data", DataError,
                               reset=True)
 
+    def test_compress_file(self):
+        """Test function _compress_file"""
+        filename_tmp = f"{THIS_DIR}/results/compress_file.fits.tmp"
+        filename = f"{THIS_DIR}/results/compress_file.fits.gz"
+        data = np.arange(10, dtype=np.float64)
+        with fitsio.FITS(filename_tmp, "rw", clobber=True) as results:
+            results.write(data, extname="TEST")
+
+        _compress_file(filename_tmp, filename)
+
+        self.assertFalse(os.path.exists(filename_tmp))
+        self.assertFalse(os.path.exists(f"{THIS_DIR}/results/compress_file.fits"))
+        with fitsio.FITS(filename) as hdul:
+            self.assertTrue(np.array_equal(hdul["TEST"].read(), data))
+
+        # failed compression: no compressed file is left behind
+        filename = f"{THIS_DIR}/results/compress_file_missing.fits.gz"
+        with self.assertRaises(FileNotFoundError):
+            _compress_file(filename_tmp, filename)
+        self.assertFalse(os.path.exists(filename))
+
     def test_data(self):
         """Test Abstract class Data
 
@@ -0,0 +1,253 @@
+"""This file contains tests related to the functions in utils_pk1d"""
+import os
+import unittest
+
+import fitsio
+import numpy as np
+
+from picca.delta_extraction.utils_pk1d import _find_bin, exp_diff
+from picca.pk1d import prep_pk1d
+from picca.tests.delta_extraction.abstract_test import AbstractTest
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def find_bin_arguments(log_lambda):
+    """Compute the grid arguments passed to _find_bin, as done in
+    _rebin_exposures
+
+    Arguments
+    ---------
+    log_lambda: array of float
+    Logarithm of the wavelengths of the grid (in Angs)
+
+    Return
+    ------
+    log_lambda_min: float
+    First value of log_lambda (0 for degenerate grids)
+
+    delta_log_lambda: float
+    Mean spacing of log_lambda (1 for degenerate grids)
+    """
+    if log_lambda.size > 1 and log_lambda[-1] > log_lambda[0]:
+        return (log_lambda[0],
+                (log_lambda[-1] - log_lambda[0]) / (log_lambda.size - 1))
+    return 0.0, 1.0
+
+
+def reference_exp_diff(exposures, log_lambda):
+    """Compute the difference between exposures as done originally, with
+    np.searchsorted and np.bincount
+
+    Arguments
+    ---------
+    exposures: list of dict
+    The exposures, in the order of the spec file HDUs
+
+    log_lambda: array of float
+    Array containing the logarithm of the wavelengths (in Angs)
+
+    Return
+    ------
+    exposure_diff: array of float
+    The difference between exposures
+    """
+    num_exp_per_col = len(exposures) // 2
+    flux_total = np.zeros((2, log_lambda.size))
+    ivar_total = np.zeros((2, log_lambda.size))
+    for index_exp in range(num_exp_per_col):
+        for index_col in range(2):
+            exposure = exposures[index_exp + index_col * num_exp_per_col]
+            log_lambda_bins = np.searchsorted(log_lambda, exposure["loglam"])
+            weights = exposure["ivar"] * (exposure["mask"] & 2**25 == 0)
+            rebin_ivar_exp = np.bincount(log_lambda_bins, weights=weights)
+            rebin_flux_exp = np.bincount(log_lambda_bins,
+                                         weights=weights * exposure["flux"])
+            size = len(rebin_ivar_exp) - 1
+            flux_total[index_exp % 2, :size] += rebin_flux_exp[:-1]
+            ivar_total[index_exp % 2, :size] += rebin_ivar_exp[:-1]
+
+    w = ivar_total > 0
+    flux_total[w] /= ivar_total[w]
+
+    alpha = 1
+    if num_exp_per_col % 2 == 1:
+        num_even_exp = (num_exp_per_col - 1) // 2
+        alpha = np.sqrt(4. * num_even_exp *
+                        (num_even_exp + 1)) / num_exp_per_col
+    return 0.5 * (flux_total[0] - flux_total[1]) * alpha
+
+
+class UtilsPk1dTest(AbstractTest):
+    """Test the functions in utils_pk1d.
+
+    Methods
+    -------
+    compare_ascii (from AbstractTest)
+    compare_fits (from AbstractTest)
+    setUp (from AbstractTest)
+    write_spec_file
+    test_exp_diff
+    test_exp_diff_few_exposures
+    test_exp_diff_rebinning
+    test_find_bin
+    """
+
+    def write_spec_file(self, filename, exposures, upper_case=False):
+        """Write a minimal spec file as read by exp_diff
+
+        Arguments
+        ---------
+        filename: str
+        Name of the file
+
+        exposures: list of dict
+        The exposures, written from HDU 4 onwards
+
+        upper_case: bool - Default: False
+        If True, write the column names of the exposures in upper case
+
+        Return
+        ------
+        hdul: fitsio.fitslib.FITS
+        The file, opened for reading
+        """
+        with fitsio.FITS(filename, "rw", clobber=True) as hdul:
+            hdul.write(None, header={"NEXP": len(exposures)})
+            for _ in range(3):
+                hdul.write({"dummy": np.zeros(1)})
+            for exposure in exposures:
+                if upper_case:
+                    exposure = {
+                        key.upper(): value for key, value in exposure.items()
+                    }
+                hdul.write(exposure)
+        return fitsio.FITS(filename)
+
+    def test_exp_diff(self):
+        """Test that exp_diff matches the original algorithm for odd and even
+        number of exposures per camera"""
+        rng = np.random.default_rng(42)
+        log_lambda = 3.56 + 1e-4 * np.arange(200)
+        for num_exp_per_col in [1, 2, 3, 4]:
+            exposures = []
+            for _ in range(2 * num_exp_per_col):
+                # exposures start below and end past the grid, and are not
+                # aligned with it
+                num_pixels = rng.integers(150, 250)
+                log_lambda_exp = (3.5595 + rng.uniform(0, 1e-4) +
+                                  1e-4 * np.arange(num_pixels))
+                mask = np.zeros(num_pixels, dtype=np.int32)
+                mask[rng.choice(num_pixels, 10, replace=False)] = 2**25
+                exposures.append({
+                    "loglam": log_lambda_exp,
+                    "flux": rng.normal(1, 0.5, num_pixels).astype(np.float32),
+                    "ivar": rng.uniform(0, 4, num_pixels).astype(np.float32),
+                    "mask": mask,
+                })
+            filename = (f"{THIS_DIR}/results/exp_diff_random_"
+                        f"{num_exp_per_col}.fits")
+            expected = reference_exp_diff(exposures, log_lambda)
+            with self.write_spec_file(filename, exposures) as hdul:
+                for function in [exp_diff, prep_pk1d.exp_diff]:
+                    exposures_diff = function(hdul, log_lambda)
+                    self.assertEqual(exposures_diff.dtype, np.float64)
+                    self.assertTrue(
+                        np.allclose(exposures_diff, expected, rtol=1e-12,
+                                    atol=0))
+
+    def test_exp_diff_few_exposures(self):
+        """Test exp_diff with none and one exposure per camera"""
+        log_lambda = 3.56 + 1e-4 * np.arange(10)
+        exposure = {
+            "loglam": log_lambda[:5],
+            "flux": np.arange(1, 6, dtype=np.float32),
+            "ivar": np.ones(5, dtype=np.float32),
+            "mask": np.zeros(5, dtype=np.int32),
+        }
+        # with no exposures there is nothing to coadd, and with one exposure
+        # per camera alpha is zero: the difference is zero in both cases
+        for num_exp_per_col in [0, 1]:
+            filename = (f"{THIS_DIR}/results/exp_diff_few_exposures_"
+                        f"{num_exp_per_col}.fits")
+            exposures = [exposure] * (2 * num_exp_per_col)
+            with self.write_spec_file(filename, exposures) as hdul:
+                for function in [exp_diff, prep_pk1d.exp_diff]:
+                    exposures_diff = function(hdul, log_lambda)
+                    self.assertTrue(
+                        np.array_equal(exposures_diff,
+                                       np.zeros(log_lambda.size)))
+
+    def test_exp_diff_rebinning(self):
+        """Test the rebinning in exp_diff on a case computed by hand
+
+        With two exposures per camera, the first exposure of each camera goes
+        to the even coadd and the second one to the odd coadd. Pixels with
+        mask 25 are ignored and the last populated bin of each exposure is
+        dropped. The column names of the spec files may be in upper case.
+        """
+        log_lambda = 3.56 + 1e-4 * np.arange(10)
+        exposure_odd = {
+            "loglam": log_lambda,
+            "flux": np.full(10, 2., dtype=np.float32),
+            "ivar": np.ones(10, dtype=np.float32),
+            "mask": np.zeros(10, dtype=np.int32),
+        }
+        exposures = [{
+            "loglam": log_lambda[:5],
+            "flux": np.arange(1, 6, dtype=np.float32),
+            "ivar": np.ones(5, dtype=np.float32),
+            "mask": np.array([0, 0, 2**25, 0, 0], dtype=np.int32),
+        }, exposure_odd, {
+            "loglam": log_lambda[2:8],
+            "flux": np.full(6, 6., dtype=np.float32),
+            "ivar": np.full(6, 3., dtype=np.float32),
+            "mask": np.zeros(6, dtype=np.int32),
+        }, exposure_odd]
+        flux_even = np.array([1., 2., 6., 5.5, 6., 6., 6., 0., 0., 0.])
+        flux_odd = np.array([2.] * 9 + [0.])
+        expected = 0.5 * (flux_even - flux_odd)
+
+        for upper_case in [False, True]:
+            filename = (f"{THIS_DIR}/results/exp_diff_rebinning_"
+                        f"{'upper' if upper_case else 'lower'}.fits")
+            with self.write_spec_file(filename, exposures,
+                                      upper_case=upper_case) as hdul:
+                for function in [exp_diff, prep_pk1d.exp_diff]:
+                    exposures_diff = function(hdul, log_lambda)
+                    self.assertTrue(np.allclose(exposures_diff, expected))
+
+    def test_find_bin(self):
+        """Test that _find_bin matches np.searchsorted"""
+        rng = np.random.default_rng(42)
+        uniform = 3.56 + 1e-4 * np.arange(1000)
+        grids = [
+            uniform,
+            # same grid, built in a different way so that the values are
+            # not exactly multiples of the spacing
+            np.log10(10**3.56 * 10**(1e-4 * np.arange(1000))),
+            np.sort(rng.uniform(3.5, 3.7, 500)),
+            np.cumsum(rng.exponential(1e-4, 500)) + 3.5,
+            np.array([3.5, 3.5, 3.5001, 3.5001, 3.6]),
+            np.array([3.6]),
+            np.array([]),
+        ]
+        for log_lambda in grids:
+            log_lambda_min, delta_log_lambda = find_bin_arguments(log_lambda)
+            values = np.concatenate([
+                log_lambda,
+                np.nextafter(log_lambda, np.inf),
+                np.nextafter(log_lambda, -np.inf),
+                rng.uniform(3.45, 3.75, 1000),
+                uniform[::7] + 0.5e-4,
+                [3., 4., -np.inf, np.inf, np.nan],
+            ])
+            for value in values:
+                self.assertEqual(
+                    _find_bin(log_lambda, value, log_lambda_min,
+                              delta_log_lambda),
+                    np.searchsorted(log_lambda, value))
+
+
+if __name__ == '__main__':
+    unittest.main()
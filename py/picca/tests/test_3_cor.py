@@ -7,6 +7,8 @@ import os
 import importlib
 import numpy as np
 
+from picca.constants import ABSORBER_IGM
+from picca.io import read_and_project_delta_file, read_delta_file
 from picca.utils import userprint
 
 ### need to load those modules here and later reload
@@ -153,6 +155,41 @@ class TestCor(AbstractTest):
 
         return
 
+    def test_read_and_project_delta_file(self):
+        """
+            Test the redshifts, rescaled weights and projected deltas
+            computed when reading a delta file
+        """
+        userprint("\n")
+        filename = self._masterFiles + "/test_delta/Delta_LYA/delta-336.fits.gz"
+        lambda_abs = ABSORBER_IGM["LYA"]
+        alpha = 2.9
+        z_ref = 2.25
+
+        for no_project in [False, True]:
+            deltas = read_and_project_delta_file(filename,
+                                                 lambda_abs,
+                                                 alpha,
+                                                 z_ref,
+                                                 no_project=no_project)
+            expected_deltas = read_delta_file(filename)
+            self.assertEqual(len(deltas), len(expected_deltas))
+            for delta, expected_delta in zip(deltas, expected_deltas):
+                z = 10**expected_delta.log_lambda / lambda_abs - 1.
+                expected_delta.weights *= ((1 + z) / (1 + z_ref))**(alpha - 1)
+                if not no_project:
+                    expected_delta.project()
+
+                self.assertTrue(np.allclose(delta.z, z, rtol=1e-12, atol=0))
+                self.assertTrue(
+                    np.allclose(delta.weights, expected_delta.weights,
+                                rtol=1e-12, atol=0))
+                self.assertTrue(
+                    np.allclose(delta.delta, expected_delta.delta, rtol=1e-12,
+                                atol=1e-15))
+
+        return
+
     def test_cf1d(self):
         """
             Test 1d correlation function
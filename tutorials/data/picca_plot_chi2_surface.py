@@ -2,7 +2,6 @@
 
 import os
 import numpy as np
-import scipy as sp
 import scipy.stats
 import matplotlib.pyplot as plt
 import argparse
@@ -71,7 +70,7 @@ if __name__ == '__main__':
         ### Read the convertion from delta-chi2 to sigma
         if not os.path.isfile(path.replace('.ap.at.scan.dat','.dchi2.to.sigma')):
             print("WARNING: did not find .dchi2.to.sigma to convert delta-chi2 to sigma, assuming Linear mapping")
-            levels = [ sp.stats.chi2.ppf( sp.stats.chi2.cdf(sigma**2,1), 2) for sigma in range(1,nbLevels+1)]
+            levels = [ scipy.stats.chi2.ppf( scipy.stats.chi2.cdf(sigma**2,1), 2) for sigma in range(1,nbLevels+1)]
         else:
             with open(path.replace('.ap.at.scan.dat','.dchi2.to.sigma')) as f:
                 for line in f:
@@ -87,7 +86,7 @@ if __name__ == '__main__':
             first_line = first_line.replace('#','')
             first_line = first_line.split()
             fromkeytoindex_bestfitfiducial = { el:i for i,el in enumerate(first_line) }
-            chi2_bestfitfiducial = sp.loadtxt(path.replace('.ap.at.scan.dat','.fiducial'))
+            chi2_bestfitfiducial = np.loadtxt(path.replace('.ap.at.scan.dat','.fiducial'))
             dhord = chi2_bestfitfiducial[fromkeytoindex_bestfitfiducial['Dh/rd']]
             dmord = chi2_bestfitfiducial[fromkeytoindex_bestfitfiducial['Dm/rd']]
         else:
@@ -1,4 +1,3 @@
-import scipy as sp
 import scipy.linalg
 import argparse
 import subprocess
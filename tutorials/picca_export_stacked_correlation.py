@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import numpy as np
-import scipy as sp
 import scipy.linalg
 import fitsio
 import argparse